@@ -5,21 +5,31 @@ MCP 语音智能体，将查询路由到 Firecrawl 网络搜索或通过 MCP 路
 from __future__ import annotations
 
 import asyncio
-import copy
+import functools
+import hashlib
 import json
 import logging
 import os
-from typing import Any, Callable, List, Optional
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, List, Optional, Union
 
+import anyio
 import inspect
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from firecrawl import Firecrawl
+from firecrawl import AsyncFirecrawl
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
 from pydantic_ai.mcp import MCPServerStdio
+from pydantic_ai.tools import ToolDefinition
 
 from livekit.agents import (
     Agent,
     AgentSession,
     JobContext,
+    JobProcess,
     RunContext,
     WorkerOptions,
     cli,
@@ -27,12 +37,24 @@ from livekit.agents import (
 )
 from livekit.plugins import assemblyai, openai, silero
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    _loads = json.loads
+
 # ------------------------------------------------------------------------------
 # 配置和日志
 # ------------------------------------------------------------------------------
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# 生产环境可设置 LOG_LEVEL=WARNING，跳过热路径上的 INFO/DEBUG 日志
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):  # 兼容 3.11 之前的 Python
+    logger.warning("无效的 LOG_LEVEL=%s，改用 INFO。", LOG_LEVEL)
+    LOG_LEVEL = "INFO"
+logger.setLevel(LOG_LEVEL)
 
 FIRECRAWL_API_KEY = os.getenv("FIRECRAWL_API_KEY")
 SUPABASE_TOKEN = os.getenv("SUPABASE_ACCESS_TOKEN")
@@ -42,6 +64,21 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "Qwen/Qwen2.5-7B-Instruct")  # OpenAI 
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:7b-instruct")  # Ollama 模型名称
 USE_LOCAL_LLM = os.getenv("USE_LOCAL_LLM", "false").lower() == "true"  # 是否强制使用本地 Ollama（优先级高于 OpenAI）
 TTS_VOICE = os.getenv("TTS_VOICE", "FunAudioLLM/CosyVoice2-0.5B:claire")  # 硅基流动 TTS 语音
+TOOL_CACHE_PATH = Path(os.getenv("TOOL_CACHE_PATH", "~/.cache/mcp-voice-agent/tools.json")).expanduser()  # MCP 工具定义的磁盘缓存
+
+# Firecrawl 搜索时间预算（秒），0 表示不限制
+try:
+    FIRECRAWL_DEADLINE = float(os.getenv("FIRECRAWL_DEADLINE", "0"))
+except ValueError:
+    logger.warning("无效的 FIRECRAWL_DEADLINE=%s，改用 0（不限制）。", os.getenv("FIRECRAWL_DEADLINE"))
+    FIRECRAWL_DEADLINE = 0.0
+
+# 最后一个会话结束后 MCP 连接保持打开的空闲时间（秒），0 表示保持到进程退出
+try:
+    MCP_IDLE_TIMEOUT = float(os.getenv("MCP_IDLE_TIMEOUT", "300"))
+except ValueError:
+    logger.warning("无效的 MCP_IDLE_TIMEOUT=%s，改用 300 秒。", os.getenv("MCP_IDLE_TIMEOUT"))
+    MCP_IDLE_TIMEOUT = 300.0
 
 if not FIRECRAWL_API_KEY:
     logger.error("环境变量中未设置 FIRECRAWL_API_KEY。")
@@ -62,12 +99,68 @@ else:
     logger.info("未检测到 OPENAI_API_KEY，将使用本地 Ollama 模型。")
     USE_OPENAI = False
 
-firecrawl_app = Firecrawl(api_key=FIRECRAWL_API_KEY)
+# 原生异步客户端：内部复用同一个 httpx.AsyncClient 连接池，无需线程池中转
+firecrawl_app = AsyncFirecrawl(api_key=FIRECRAWL_API_KEY)
+
+# 按 (工具名, 定义哈希) 缓存 function_tool 装饰后的代理，跳过重复的 Pydantic 模型构建
+# 代理本身不绑定服务器，调用时通过会话的 userdata 找到该会话持有的 MCP 连接
+_FUNCTION_TOOL_CACHE: dict[tuple[str, int], Callable] = {}
+
+
+def _tool_key(name: str, description: Optional[str], schema: dict) -> str:
+    """
+    将工具定义序列化为稳定的字符串，用作缓存键（dict 不可哈希）。
+
+    文档字符串由描述生成，因此描述也必须参与缓存键。
+    """
+    return json.dumps([name, description, schema], sort_keys=True)
+
+
+@dataclass(frozen=True)
+class PropSchema:
+    """
+    单个属性的 JSON schema，只保留构建工具所需的字段。
+
+    一次性从 dict 解析，之后按属性访问。
+    """
+
+    type: Union[str, tuple[str, ...], None] = None
+    items: Optional[PropSchema] = None
+    description: str = ""
+    default: Any = inspect.Parameter.empty
+
+    @classmethod
+    def from_schema(cls, schema: dict) -> PropSchema:
+        t = schema.get("type")
+        items = schema.get("items")
+        return cls(
+            type=tuple(t) if isinstance(t, list) else t,
+            items=cls.from_schema(items) if isinstance(items, dict) else None,
+            description=schema.get("description") or "",
+            default=schema.get("default", inspect.Parameter.empty),
+        )
+
+    @property
+    def is_array(self) -> bool:
+        t = self.type
+        return t == "array" or (isinstance(t, tuple) and "array" in t)
+
+
+_EMPTY_PROP = PropSchema()
+
+# 必填参数不超过该数量时用 tuple 做成员判断，比构建 set 更省
+_SMALL_REQUIRED = 8
+
+
+def _required_names(schema: dict) -> Union[tuple, frozenset]:
+    """返回 schema 中的必填参数名：少量时为 tuple，否则为 frozenset。"""
+    required = tuple(schema.get("required", ()))
+    return required if len(required) <= _SMALL_REQUIRED else frozenset(required)
 
 
-def _py_type(schema: dict) -> Any:
+def _py_type(prop: PropSchema) -> Any:
     """将 JSON schema 类型转换为 Python 类型注解。"""
-    t = schema.get("type")
+    t = prop.type
     mapping = {
         "string": str,
         "integer": int,
@@ -76,50 +169,150 @@ def _py_type(schema: dict) -> Any:
         "object": dict,
     }
 
-    if isinstance(t, list):
+    if isinstance(t, tuple):
         if "array" in t:
-            return List[_py_type(schema.get("items", {}))]
+            return List[_py_type(prop.items or _EMPTY_PROP)]
         t = t[0]
 
     if isinstance(t, str) and t in mapping:
         return mapping[t]
     if t == "array":
-        return List[_py_type(schema.get("items", {}))]
+        return List[_py_type(prop.items or _EMPTY_PROP)]
 
     return Any
 
 
-def schema_to_google_docstring(description: str, schema: dict) -> str:
+# 文档字符串中 JSON schema 类型的显示名称
+_FORMAT = {
+    "string": "String",
+    "integer": "Integer",
+    "number": "Number",
+    "boolean": "Boolean",
+    "object": "Object",
+    "array": "Array",
+    "null": "Null",
+}
+
+
+def _format_name(t: Optional[str]) -> str:
+    if not t:
+        return "Any"
+    return _FORMAT.get(t) or t.capitalize()
+
+
+def _format_type(prop: PropSchema) -> str:
+    """返回属性在文档字符串中显示的类型字符串。"""
+    if prop.is_array:
+        return f"List[{_format_name(prop.items.type if prop.items else None)}]"
+    t = prop.type
+    return _format_name(t[0] if isinstance(t, tuple) else t)
+
+
+def schema_to_google_docstring(
+    description: str,
+    props: dict[str, PropSchema],
+    required: Union[tuple, frozenset],
+) -> str:
     """
-    从 JSON schema 生成 Google 风格的文档字符串部分。
+    从解析后的 JSON schema 属性生成 Google 风格的文档字符串部分。
     """
-    props = schema.get("properties", {})
-    required = set(schema.get("required", []))
     lines = [description or "", "参数:"]
 
     for name, prop in props.items():
-        t = prop.get("type", "Any")
-        if isinstance(t, list):
-            if "array" in t:
-                subtype = prop.get("items", {}).get("type", "Any")
-                py_type = f"List[{subtype.capitalize()}]"
-            else:
-                py_type = t[0].capitalize()
-        elif t == "array":
-            subtype = prop.get("items", {}).get("type", "Any")
-            py_type = f"List[{subtype.capitalize()}]"
-        else:
-            py_type = t.capitalize()
-
+        py_type = _format_type(prop)
         if name not in required:
             py_type = f"Optional[{py_type}]"
 
-        desc = prop.get("description", "")
-        lines.append(f"    {name} ({py_type}): {desc}")
+        lines.append(f"    {name} ({py_type}): {prop.description}")
 
     return "\n".join(lines)
 
 
+# Firecrawl 结果缓存：吸收 LLM 在短时间内重复发出的相同搜索
+_FC_CACHE: TTLCache = TTLCache(maxsize=256, ttl=30)
+# 进行中的搜索：并发的相同 (query, limit) 共享同一个任务的结果
+_FC_INFLIGHT: dict[tuple[str, int], asyncio.Task] = {}
+
+# 回退抓取时的最大并发数，避免过度并行导致性能回退
+_SCRAPE_CONCURRENCY = 8
+
+
+async def _scrape_urls(urls: List[str]) -> AsyncIterator[str]:
+    """并发抓取搜索结果中未附带正文的页面，按完成顺序逐个产出 markdown 内容。"""
+    semaphore = asyncio.Semaphore(_SCRAPE_CONCURRENCY)
+
+    async def scrape_one(url: str) -> str:
+        async with semaphore:
+            try:
+                doc = await firecrawl_app.scrape(url, formats=["markdown"])
+            except Exception as e:
+                logger.warning("Firecrawl 抓取 %s 失败：%s", url, e)
+                return ""
+        return doc.markdown or ""
+
+    tasks = [asyncio.ensure_future(scrape_one(u)) for u in urls]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            page = await next_done
+            if page:
+                yield page
+    finally:
+        # 调用方提前停止（如超出时间预算）时，取消尚未完成的抓取
+        for task in tasks:
+            task.cancel()
+
+
+async def _iter_firecrawl_pages(query: str, limit: int) -> AsyncIterator[str]:
+    """调用 Firecrawl /search，并在页面就绪时逐个产出其内容，失败时抛出异常。"""
+    logger.debug("开始 Firecrawl 搜索：%s（限制=%d）", query, limit)
+
+    # /search 一次请求即可在服务端并行抓取全部结果页面
+    result = await firecrawl_app.search(
+        query=query,
+        limit=limit,
+        scrape_options={"formats": ["markdown"]},
+    )
+    missing = []
+    for item in result.web or []:
+        markdown = getattr(item, "markdown", None)
+        if markdown:
+            yield markdown
+        elif getattr(item, "url", None):
+            missing.append(item.url)
+
+    if missing:
+        async for page in _scrape_urls(missing):
+            yield page
+
+
+async def _firecrawl_fetch(query: str, limit: int) -> tuple[List[str], bool]:
+    """
+    收集 Firecrawl 页面内容，返回 (页面列表, 是否完整)。
+
+    设置了 FIRECRAWL_DEADLINE 时，超出时间预算后返回已就绪的页面，
+    避免个别慢页面拖慢整个回复。
+    """
+    pages: List[str] = []
+
+    async def collect() -> None:
+        async for page in _iter_firecrawl_pages(query, limit):
+            pages.append(page)
+
+    complete = True
+    if FIRECRAWL_DEADLINE > 0:
+        try:
+            await asyncio.wait_for(collect(), FIRECRAWL_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.warning("Firecrawl 搜索超出 %.1f 秒时间预算，返回已就绪的页面。", FIRECRAWL_DEADLINE)
+            complete = False
+    else:
+        await collect()
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Firecrawl 返回了 %d 个页面", len(pages))
+    return pages, complete
+
+
 @function_tool
 async def firecrawl_search(
     context: RunContext,
@@ -132,39 +325,114 @@ async def firecrawl_search(
     参数:
         context (RunContext): LiveKit 运行时上下文。
         query (str): 搜索查询字符串。
-        limit (int): 要爬取的最大页面数。
+        limit (int): 要返回的最大搜索结果数。
 
     返回:
         List[str]: 原始页面内容。
     """
-    url = f"https://www.google.com/search?q={query}"
-    logger.debug("开始对 URL 进行 Firecrawl 搜索：%s（限制=%d）", url, limit)
+    key = (query, limit)
+    cached = _FC_CACHE.get(key)
+    if cached is not None:
+        logger.debug("Firecrawl 缓存命中：%s（限制=%d）", query, limit)
+        return list(cached)
+
+    task = _FC_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_firecrawl_fetch(query, limit))
+        _FC_INFLIGHT[key] = task
+
+        def done(t: asyncio.Task) -> None:
+            del _FC_INFLIGHT[key]
+            # 超出时间预算的部分结果不缓存
+            if not t.cancelled() and t.exception() is None:
+                pages, complete = t.result()
+                if complete:
+                    _FC_CACHE[key] = pages
+
+        task.add_done_callback(done)
+    else:
+        logger.debug("合并进行中的 Firecrawl 搜索：%s（限制=%d）", query, limit)
 
-    loop = asyncio.get_event_loop()
     try:
-        result = await loop.run_in_executor(
-            None,
-            lambda: firecrawl_app.crawl(
-                url=url,
-                limit=limit,
-                formats=["markdown", "text"]
-            )
-        )
-        # 新版 API 返回的是 job 对象，包含 data 字段
-        data = result.data if hasattr(result, 'data') else result
-        logger.info("Firecrawl 返回了 %d 个页面", len(data) if isinstance(data, list) else 1)
-        return data
+        # shield：某个调用方被取消时，不影响其他等待同一结果的调用方
+        pages, _ = await asyncio.shield(task)
+        return list(pages)
     except Exception as e:
         logger.error("Firecrawl 搜索失败：%s", e, exc_info=True)
         return []
 
 
-async def build_livekit_tools(server: MCPServerStdio) -> List[Callable]:
+def make_proxy(
+    tool_def: Any,
+    props: dict[str, PropSchema],
+    required: Union[tuple, frozenset],
+) -> Callable:
+    """
+    为单个 MCP 工具构建 LiveKit 代理函数并用 function_tool 装饰。
+    """
+    # 注册时一次性找出数组类型的参数，避免每次调用都遍历 kwargs
+    _array_keys = tuple(k for k, p in props.items() if p.is_array)
+
+    async def proxy(context: RunContext, **kwargs):
+        # 将数组参数的 None 转换为 []
+        for k in _array_keys:
+            if k in kwargs and kwargs[k] is None:
+                kwargs[k] = []
+
+        # 每个会话固定使用连接时获得的服务器，不受其他会话重连的影响
+        conn = context.userdata.mcp
+        try:
+            response = await conn.server.call_tool(tool_def.name, arguments=kwargs or None)
+        except Exception as e:
+            if _is_transport_error(e):
+                _drop_shared_supabase(conn)
+            raise
+        # 最常见的情况是带 content 的结果对象；列表等其他返回值原样透传
+        try:
+            content = response.content
+        except AttributeError:
+            return response
+        if not content:
+            return response
+
+        text = content[0].text
+        try:
+            return _loads(text)
+        except json.JSONDecodeError:  # orjson.JSONDecodeError 同样是其子类
+            return text
+
+    # 从 schema 构建函数签名：单次遍历属性，每个属性只计算一次类型注解
+    params = [
+        inspect.Parameter("context", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=RunContext)
+    ]
+    ann = {"context": RunContext}
+
+    for name, ps in props.items():
+        pyt = ann[name] = _py_type(ps)
+        default = ps.default
+        if default is inspect.Parameter.empty and name not in required:
+            default = None
+        params.append(inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY, annotation=pyt, default=default))
+
+    proxy.__signature__ = inspect.Signature(params)
+    proxy.__annotations__ = ann
+    proxy.__name__ = tool_def.name
+    proxy.__doc__ = schema_to_google_docstring(tool_def.description or "", props, required)
+    return function_tool(proxy)
+
+
+async def build_livekit_tools(
+    server: MCPServerStdio,
+    all_tools: Optional[List[ToolDefinition]] = None,
+) -> List[Callable]:
     """
     从 Supabase MCP 服务器构建 LiveKit 工具。
+
+    传入 all_tools 时直接使用这些工具定义，不再调用 list_tools()。
     """
     tools: List[Callable] = []
-    all_tools = await server.list_tools()
+    if all_tools is None:
+        all_tools = await server.list_tools()
     logger.info("找到 %d 个 MCP 工具", len(all_tools))
 
     for td in all_tools:
@@ -172,99 +440,348 @@ async def build_livekit_tools(server: MCPServerStdio) -> List[Callable]:
             logger.warning("跳过工具 %s", td.name)
             continue
 
-        schema = copy.deepcopy(td.parameters_json_schema)
+        # 代理从不修改 schema，因此仅在需要打补丁的 list_tables 上做浅拷贝
+        schema = td.parameters_json_schema
         if td.name == "list_tables":
-            props = schema.setdefault("properties", {})
-            props["schemas"] = {
-                "type": ["array", "null"],
-                "items": {"type": "string"},
-                "default": []
+            schema = {**schema}
+            schema["properties"] = {
+                **schema.get("properties", {}),
+                "schemas": {
+                    "type": ["array", "null"],
+                    "items": {"type": "string"},
+                    "default": []
+                },
             }
-            schema["required"] = [r for r in schema.get("required", []) if r != "schemas"]
-
-        props = schema.get("properties", {})
-        required = set(schema.get("required", []))
-
-        def make_proxy(
-            tool_def=td,
-            _props=props,
-            _required=required,
-            _schema=schema
-        ) -> Callable:
-            async def proxy(context: RunContext, **kwargs):
-                # 将数组参数的 None 转换为 []
-                for k, v in list(kwargs.items()):
-                    if ((_props[k].get("type") == "array"
-                         or "array" in (_props[k].get("type") or []))
-                            and v is None):
-                        kwargs[k] = []
-
-                response = await server.call_tool(tool_def.name, arguments=kwargs or None)
-                if isinstance(response, list):
-                    return response
-                if hasattr(response, "content") and response.content:
-                    text = response.content[0].text
-                    try:
-                        return json.loads(text)
-                    except json.JSONDecodeError:
-                        return text
-                return response
-
-            # 从 schema 构建函数签名
-            params = [
-                inspect.Parameter("context", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=RunContext)
-            ]
-            ann = {"context": RunContext}
-
-            for name, ps in _props.items():
-                default = ps.get("default", inspect._empty if name in required else None)
-                params.append(
-                    inspect.Parameter(
-                        name,
-                        inspect.Parameter.KEYWORD_ONLY,
-                        annotation=_py_type(ps),
-                        default=default,
-                    )
-                )
-                ann[name] = _py_type(ps)
-
-            proxy.__signature__ = inspect.Signature(params)
-            proxy.__annotations__ = ann
-            proxy.__name__ = tool_def.name
-            proxy.__doc__ = schema_to_google_docstring(tool_def.description or "", _schema)
-            return function_tool(proxy)
-
-        tools.append(make_proxy())
+            req = schema.get("required")
+            if req and "schemas" in req:
+                schema["required"] = [r for r in req if r != "schemas"]
+
+        cache_key = (td.name, hash(_tool_key(td.name, td.description, schema)))
+        cached_tool = _FUNCTION_TOOL_CACHE.get(cache_key)
+        if cached_tool is not None:
+            tools.append(cached_tool)
+            continue
+
+        # 只解析一次 schema，后续全部基于 PropSchema 的属性访问
+        props = {
+            name: PropSchema.from_schema(ps)
+            for name, ps in schema.get("properties", {}).items()
+        }
+        required = _required_names(schema)
+
+        tool = make_proxy(td, props, required)
+        _FUNCTION_TOOL_CACHE[cache_key] = tool
+        tools.append(tool)
 
     return tools
 
 
-async def entrypoint(ctx: JobContext) -> None:
+def _tool_list_hash(tool_defs: List[ToolDefinition]) -> str:
     """
-    LiveKit 智能体的主入口点。
+    计算工具定义列表的稳定哈希，用于校验磁盘缓存。
+
+    与工具构建缓存共用 _tool_key，保证两者按相同的字段判断定义是否变化。
     """
-    await ctx.connect()
-    
-    # 尝试连接 Supabase MCP 服务器（可选）
-    supabase_tools = []
-    server = None
-    
-    if SUPABASE_TOKEN:
-        try:
-            logger.info("尝试连接 Supabase MCP 服务器...")
-            server = MCPServerStdio(
-                "npx",
-                args=["-y", "@supabase/mcp-server-postgrest@latest", "--access-token", SUPABASE_TOKEN],
+    payload = "\n".join(_tool_key(td.name, td.description, td.parameters_json_schema) for td in tool_defs)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _load_tool_cache(server_key: str) -> Optional[tuple[str, List[ToolDefinition]]]:
+    """读取磁盘上的工具定义缓存，服务器不匹配或文件损坏时返回 None。"""
+    try:
+        data = json.loads(TOOL_CACHE_PATH.read_text(encoding="utf-8"))
+        if data.get("server") != server_key:
+            return None
+        tool_defs = [
+            ToolDefinition(
+                name=t["name"],
+                description=t.get("description"),
+                parameters_json_schema=t["parameters_json_schema"],
             )
-            await server.__aenter__()
-            supabase_tools = await build_livekit_tools(server)
-            logger.info(f"Supabase MCP 连接成功，获得 {len(supabase_tools)} 个工具。")
+            for t in data["tools"]
+        ]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    tool_hash = _tool_list_hash(tool_defs)
+    if tool_hash != data.get("hash"):
+        return None
+    return tool_hash, tool_defs
+
+
+def _save_tool_cache(server_key: str, tool_defs: List[ToolDefinition]) -> None:
+    """将工具定义写入磁盘缓存（先写临时文件再替换，避免读到半截文件）。"""
+    data = {
+        "server": server_key,
+        "hash": _tool_list_hash(tool_defs),
+        "tools": [
+            {
+                "name": td.name,
+                "description": td.description,
+                "parameters_json_schema": td.parameters_json_schema,
+            }
+            for td in tool_defs
+        ],
+    }
+    try:
+        TOOL_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        # 每次写入使用唯一的临时文件，多个进程同时写缓存时互不覆盖
+        fd, tmp_path = tempfile.mkstemp(dir=TOOL_CACHE_PATH.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(json.dumps(data, ensure_ascii=False))
+            os.replace(tmp_path, TOOL_CACHE_PATH)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("写入 MCP 工具缓存失败：%s", e)
+
+
+_MCP_SERVER_ARGS = ["-y", "@supabase/mcp-server-postgrest@latest", "--access-token", SUPABASE_TOKEN or ""]
+# 缓存按服务器命令行（含令牌）的哈希区分，文件中不保存令牌本身
+_MCP_SERVER_KEY = hashlib.sha256(json.dumps(_MCP_SERVER_ARGS).encode("utf-8")).hexdigest()
+# 最近一次得到的工具定义及其哈希：进程启动时预读磁盘缓存，冷启动时可跳过 list_tools() RPC；
+# 之后每次 list_tools() 都会更新，重连时使用最新定义
+_PERSISTED_TOOLS = _load_tool_cache(_MCP_SERVER_KEY) if SUPABASE_TOKEN else None
+
+
+def _remember_tool_defs(tool_defs: List[ToolDefinition]) -> None:
+    """记录最新的工具定义：更新内存中的快照并写入磁盘缓存。"""
+    global _PERSISTED_TOOLS
+
+    _PERSISTED_TOOLS = (_tool_list_hash(tool_defs), tool_defs)
+    _save_tool_cache(_MCP_SERVER_KEY, tool_defs)
+
+
+@dataclass(eq=False)
+class _MCPConnection:
+    """进程内共享的一条 Supabase MCP 连接，及其工具和使用者计数。"""
+
+    server: MCPServerStdio
+    # 持有连接的专用任务及其停止信号
+    task: asyncio.Task
+    stop: asyncio.Event
+    tools: List[Callable] = field(default_factory=list)
+    # 当前使用该连接的会话数
+    users: int = 0
+    # 空闲关闭定时器；有会话复用时取消
+    idle_handle: Optional[asyncio.TimerHandle] = None
+    # 后台校验磁盘缓存的任务（保留引用，防止被垃圾回收）
+    revalidate_task: Optional[asyncio.Task] = None
+
+    def close(self) -> None:
+        """通知专用任务关闭连接，并取消与该连接相关的后台任务。"""
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.revalidate_task is not None:
+            self.revalidate_task.cancel()
+        self.stop.set()
+
+
+@dataclass
+class SessionData:
+    """会话级状态，作为 AgentSession 的 userdata，工具代理通过 RunContext 访问。"""
+
+    mcp: Optional[_MCPConnection] = None
+
+
+# 进程内共享的连接，避免每个会话都重新启动 npx 子进程
+_SHARED_MCP: Optional[_MCPConnection] = None
+_SHARED_MCP_LOCK = asyncio.Lock()
+
+# MCP 子进程崩溃或 stdio 管道断开时抛出的异常
+_MCP_TRANSPORT_ERRORS = (
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    OSError,
+)
+
+
+def _is_transport_error(e: BaseException) -> bool:
+    """判断异常是否表示 MCP 连接已失效（而非工具本身返回的错误）。"""
+    if isinstance(e, _MCP_TRANSPORT_ERRORS):
+        return True
+    return isinstance(e, McpError) and e.error.code == CONNECTION_CLOSED
+
+
+def _drop_shared_supabase(conn: _MCPConnection) -> None:
+    """
+    连接失效时关闭该连接；若它仍是共享连接则将其丢弃，使下一个会话重新连接。
+    """
+    global _SHARED_MCP
+
+    conn.close()
+    if _SHARED_MCP is not conn:
+        return
+    logger.warning("Supabase MCP 连接已断开，下一个会话将重新连接。")
+    _SHARED_MCP = None
+
+
+def _close_idle_supabase(conn: _MCPConnection) -> None:
+    """空闲超时后关闭无人使用的共享连接。"""
+    global _SHARED_MCP
+
+    conn.idle_handle = None
+    if _SHARED_MCP is not conn or conn.users > 0:
+        return
+    logger.info("Supabase MCP 连接空闲超过 %.0f 秒，关闭连接。", MCP_IDLE_TIMEOUT)
+    conn.close()
+    _SHARED_MCP = None
+
+
+async def _serve_mcp(server: MCPServerStdio, ready: asyncio.Future, stop: asyncio.Event) -> None:
+    """
+    在专用任务中持有 MCP 连接，直到收到停止信号。
+
+    anyio 要求 __aenter__ 与 __aexit__ 在同一任务中执行，
+    因此连接不能由某个会话的任务打开、再由另一个会话关闭。
+    """
+    try:
+        async with server:
+            ready.set_result(None)
+            await stop.wait()
+    except Exception as e:
+        if not ready.done():
+            ready.set_exception(e)
+        else:
+            logger.warning("关闭 Supabase MCP 连接时出错：%s", e)
+    finally:
+        if not ready.done():
+            ready.cancel()
+
+
+async def _revalidate_tool_cache(conn: _MCPConnection, cached_hash: str) -> None:
+    """
+    在后台重新获取工具列表；若与磁盘缓存不一致，则更新缓存和连接的工具。
+    """
+    try:
+        tool_defs = await conn.server.list_tools()
+        if _tool_list_hash(tool_defs) == cached_hash:
+            return
+        logger.info("MCP 工具定义已变化，更新工具缓存（新的会话将使用新工具）。")
+        conn.tools = await build_livekit_tools(conn.server, tool_defs)
+        _remember_tool_defs(tool_defs)
+    except Exception as e:
+        logger.warning("校验 MCP 工具缓存失败：%s", e)
+        if _is_transport_error(e):
+            _drop_shared_supabase(conn)
+
+
+async def connect_supabase() -> Optional[_MCPConnection]:
+    """
+    获取共享的 Supabase MCP 连接（可选），首次调用时建立连接并构建工具。
+
+    连接由专用任务持有；调用方在会话结束时应调用 release_supabase()。
+    最后一个会话结束后连接继续保持 MCP_IDLE_TIMEOUT 秒以供后续会话复用，
+    连接失效后下一次调用会重新连接。
+    磁盘上有匹配的工具定义缓存时直接使用，并在后台校验是否过期。
+    """
+    global _SHARED_MCP
+
+    if not SUPABASE_TOKEN:
+        logger.info("未配置 SUPABASE_ACCESS_TOKEN，跳过 Supabase MCP 连接。")
+        return None
+
+    async with _SHARED_MCP_LOCK:
+        conn = _SHARED_MCP
+        if conn is not None:
+            logger.info("复用已连接的 Supabase MCP 服务器。")
+            if conn.idle_handle is not None:
+                conn.idle_handle.cancel()
+                conn.idle_handle = None
+            conn.users += 1
+            return conn
+
+        logger.info("尝试连接 Supabase MCP 服务器...")
+        server = MCPServerStdio("npx", args=_MCP_SERVER_ARGS)
+        ready = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+        conn = _MCPConnection(server, asyncio.create_task(_serve_mcp(server, ready, stop)), stop)
+        try:
+            await ready
+            if _PERSISTED_TOOLS is not None:
+                cached_hash, tool_defs = _PERSISTED_TOOLS
+                logger.info("使用磁盘缓存的 MCP 工具定义：%s", TOOL_CACHE_PATH)
+                conn.tools = await build_livekit_tools(server, tool_defs)
+                conn.revalidate_task = asyncio.create_task(_revalidate_tool_cache(conn, cached_hash))
+            else:
+                tool_defs = await server.list_tools()
+                conn.tools = await build_livekit_tools(server, tool_defs)
+                _remember_tool_defs(tool_defs)
+            logger.info("Supabase MCP 连接成功，获得 %d 个工具。", len(conn.tools))
         except Exception as e:
-            logger.warning(f"Supabase MCP 连接失败：{e}")
+            logger.warning("Supabase MCP 连接失败：%s", e)
             logger.warning("将继续使用 Firecrawl 搜索功能。")
-            server = None
-    else:
-        logger.info("未配置 SUPABASE_ACCESS_TOKEN，跳过 Supabase MCP 连接。")
+            conn.close()
+            await conn.task
+            return None
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+
+        conn.users = 1
+        _SHARED_MCP = conn
+        return conn
+
+
+async def release_supabase(conn: _MCPConnection) -> None:
+    """
+    会话结束时释放共享连接。
+
+    最后一个使用者离开后不立即关闭连接，而是在空闲 MCP_IDLE_TIMEOUT 秒后关闭
+    （为 0 时保持到进程退出），使后续会话无需重新启动 npx 子进程。
+    """
+    async with _SHARED_MCP_LOCK:
+        # 连接已因故障被丢弃并可能已重连，旧会话的释放不影响新连接
+        if conn is not _SHARED_MCP:
+            return
+        conn.users -= 1
+        if conn.users > 0 or MCP_IDLE_TIMEOUT <= 0:
+            return
+        conn.idle_handle = asyncio.get_running_loop().call_later(
+            MCP_IDLE_TIMEOUT, _close_idle_supabase, conn
+        )
+
+
+@functools.cache
+def load_vad() -> silero.VAD:
+    """加载 silero VAD 模型权重，每个进程只加载一次并在会话间共享。"""
+    return silero.VAD.load(min_silence_duration=0.1)
+
+
+def prewarm(proc: JobProcess) -> None:
+    """作业进程启动时预加载 VAD，使会话开始时无需再从磁盘加载模型。"""
+    load_vad()
+
+
+async def entrypoint(ctx: JobContext) -> None:
+    """
+    LiveKit 智能体的主入口点。
+    """
+    await ctx.connect()
+
+    # 并发执行 MCP 连接（list_tools RPC）与同步的 VAD/STT 初始化（放到线程池中）；
+    # VAD 通常已在 prewarm 中加载，此处直接命中缓存
+    mcp, vad, stt = await asyncio.gather(
+        connect_supabase(),
+        asyncio.to_thread(load_vad),
+        asyncio.to_thread(assemblyai.STT),
+        return_exceptions=True,
+    )
+    # 先检查每个结果再使用；连接失败时 connect_supabase 不会持有连接
+    if isinstance(mcp, BaseException):
+        raise mcp
+    supabase_tools: List[Callable] = []
+    if mcp is not None:
+        supabase_tools = mcp.tools
+
+        async def _release_supabase() -> None:
+            await release_supabase(mcp)
+
+        ctx.add_shutdown_callback(_release_supabase)
     
     # 构建工具列表
     tools = [firecrawl_search] + supabase_tools
@@ -288,59 +805,66 @@ async def entrypoint(ctx: JobContext) -> None:
         tools=tools,
     )
 
-    try:
+    # MCP 连接成功时释放回调已注册，此处抛出不会泄漏连接
+    if isinstance(vad, BaseException):
+        raise vad
+    if isinstance(stt, BaseException):
+        raise stt
 
-        # 根据配置选择 LLM
-        if USE_OPENAI:
-            if OPENAI_BASE_URL:
-                llm = openai.LLM(model=OPENAI_MODEL, base_url=OPENAI_BASE_URL)
-                logger.info(f"使用自定义 OpenAI API 端点：{OPENAI_BASE_URL}")
-            else:
-                llm = openai.LLM(model=OPENAI_MODEL)
-                logger.info("使用官方 OpenAI API。")
-            logger.info(f"使用 OpenAI {OPENAI_MODEL} 模型。")
-        else:
-            # 使用 Ollama（通过 openai 插件提供）
-            llm = openai.LLM.with_ollama(
-                model=OLLAMA_MODEL,
-                base_url="http://localhost:11434/v1"
-            )
-            logger.info(f"使用本地 Ollama {OLLAMA_MODEL} 模型。")
-        
-        # 使用硅基流动 TTS（通过 OpenAI 兼容接口）
-        if not OPENAI_API_KEY:
-            logger.error("TTS 配置错误：未设置 OPENAI_API_KEY。")
-            logger.error("请在 .env 文件中配置：OPENAI_API_KEY=your-siliconflow-key")
-            raise EnvironmentError("需要配置 OPENAI_API_KEY 用于硅基流动 TTS。")
-        
+    # 根据配置选择 LLM
+    if USE_OPENAI:
         if OPENAI_BASE_URL:
-            tts = openai.TTS(voice=TTS_VOICE, base_url=OPENAI_BASE_URL)
+            llm = openai.LLM(model=OPENAI_MODEL, base_url=OPENAI_BASE_URL)
+            logger.info("使用自定义 OpenAI API 端点：%s", OPENAI_BASE_URL)
         else:
-            tts = openai.TTS(voice=TTS_VOICE)
-        logger.info(f"使用硅基流动 TTS（语音: {TTS_VOICE}）。")
-        
-        session = AgentSession(
-            vad=silero.VAD.load(min_silence_duration=0.1),
-            stt=assemblyai.STT(),
-            llm=llm,
-            tts=tts,
+            llm = openai.LLM(model=OPENAI_MODEL)
+            logger.info("使用官方 OpenAI API。")
+        logger.info("使用 OpenAI %s 模型。", OPENAI_MODEL)
+    else:
+        # 使用 Ollama（通过 openai 插件提供）
+        llm = openai.LLM.with_ollama(
+            model=OLLAMA_MODEL,
+            base_url="http://localhost:11434/v1"
         )
+        logger.info("使用本地 Ollama %s 模型。", OLLAMA_MODEL)
 
-        await session.start(agent=agent, room=ctx.room)
-        # await session.generate_reply(instructions="你好！我今天能为您做些什么？")  # 跳过初始问候，直接开始对话
-        logger.info("Agent 已就绪，等待用户输入。按 Ctrl+B 切换文本/音频模式。")
+    # 使用硅基流动 TTS（通过 OpenAI 兼容接口）
+    if not OPENAI_API_KEY:
+        logger.error("TTS 配置错误：未设置 OPENAI_API_KEY。")
+        logger.error("请在 .env 文件中配置：OPENAI_API_KEY=your-siliconflow-key")
+        raise EnvironmentError("需要配置 OPENAI_API_KEY 用于硅基流动 TTS。")
 
-        # 保持会话活动直到取消
-        try:
-            while True:
-                await asyncio.sleep(1)
-        except asyncio.CancelledError:
-            logger.info("会话已取消，正在关闭。")
+    if OPENAI_BASE_URL:
+        tts = openai.TTS(voice=TTS_VOICE, base_url=OPENAI_BASE_URL)
+    else:
+        tts = openai.TTS(voice=TTS_VOICE)
+    logger.info("使用硅基流动 TTS（语音: %s）。", TTS_VOICE)
+
+    session = AgentSession(
+        vad=vad,
+        stt=stt,
+        llm=llm,
+        tts=tts,
+        userdata=SessionData(mcp=mcp),
+    )
 
-    finally:
-        if server:
-            await server.__aexit__(None, None, None)
+    await session.start(agent=agent, room=ctx.room)
+    # await session.generate_reply(instructions="你好！我今天能为您做些什么？")  # 跳过初始问候，直接开始对话
+    logger.info("Agent 已就绪，等待用户输入。按 Ctrl+B 切换文本/音频模式。")
+
+    # 保持会话活动直到任务关闭或被取消（不做周期性唤醒）
+    stop = asyncio.Event()
+
+    async def _on_shutdown() -> None:
+        stop.set()
+
+    ctx.add_shutdown_callback(_on_shutdown)
+    try:
+        await stop.wait()
+        logger.info("会话已结束，正在关闭。")
+    except asyncio.CancelledError:
+        logger.info("会话已取消，正在关闭。")
 
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))